@@ -5,16 +5,38 @@ import logging
 import os
 import shutil
 import sys
+import tempfile
 import wave
+import zipfile
 from decimal import Decimal
+from multiprocessing.dummy import Pool
 
+import numpy
+import sox
 from slugify import slugify
 
+from layout import (SHARD_ROOT, get_flat_dir, get_shard_dir,
+                    get_working_dir, list_file_ids, list_flat_file_ids)
+
 AUDIO_EXTS = ['.wav', '.mp3']
+ARCHIVE_EXT = '.zip'
+ARCHIVE_INDEX = 'index.json'
+ARCHIVE_BLOCK = 30
+SHARD_WORKERS = 16
+
+# fingerprint parameters: decode rate, fingerprint length in bits,
+# silence amplitude, number of index bands and maximum hamming distance
+# for a duplicate
+FP_RATE = 8000
+FP_SILENCE = 0.01
+FP_BITS = 128
+FP_BANDS = 8
+FP_MAX_DIST = FP_BANDS - 1
 
 # initialize path and logger
 CUR_DIR = os.path.dirname(os.path.realpath(__name__))
 DATA_DIR = os.path.join(CUR_DIR, 'data/')
+FP_INDEX = os.path.join(CUR_DIR, 'fingerprints.json')
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
 logging.basicConfig(level=logging.INFO)
@@ -36,29 +58,226 @@ def crawl_folder(path, ext_list):
                 LOG.info('Processed %s', file_)
 
 
+def fingerprint(file_path):
+    """
+    Return an acoustic fingerprint of an audio file as a hex string.
+    The file is decoded to 8kHz mono PCM, trimmed of silence at both ends
+    and cut into FP_BITS + 1 chunks, each bit being whether energy rises
+    from one chunk to the next.
+    Return None if the file is too short to fingerprint.
+    """
+    handle, temp_file = tempfile.mkstemp(suffix='.wav')
+    os.close(handle)
+    try:
+        tfm = sox.Transformer()
+        tfm.convert(samplerate=FP_RATE, n_channels=1, bitdepth=16)
+        tfm.build(file_path, temp_file)
+        file_ = wave.open(temp_file, 'r')
+        frames = file_.readframes(file_.getnframes())
+        file_.close()
+    finally:
+        os.remove(temp_file)
+
+    # trim leading and trailing silence, e.g. padding added by encoders
+    samples = numpy.frombuffer(frames, dtype='<i2').astype(numpy.float64)
+    loud = numpy.flatnonzero(numpy.abs(samples) > FP_SILENCE * 32768)
+    if len(loud) < FP_RATE:
+        return None
+    samples = samples[loud[0]:loud[-1] + 1]
+    chunk_len = len(samples) // (FP_BITS + 1)
+    chunks = samples[:chunk_len * (FP_BITS + 1)].reshape(FP_BITS + 1, -1)
+    energy = numpy.einsum('ij,ij->i', chunks, chunks)
+    bits = ''.join('1' if bit else '0' for bit in numpy.diff(energy) > 0)
+    return '{:0{}x}'.format(int(bits, 2), FP_BITS // 4)
+
+
+def fp_bands(fp_):
+    """Split a fingerprint into index keys, one per band."""
+    width = len(fp_) // FP_BANDS
+    return ['{}:{}'.format(i, fp_[i * width:(i + 1) * width])
+            for i in range(FP_BANDS)]
+
+
+def fp_distance(fp_1, fp_2):
+    """Return the hamming distance between two fingerprints."""
+    return bin(int(fp_1, 16) ^ int(fp_2, 16)).count('1')
+
+
+def load_fp_index():
+    """
+    Load fingerprints.json and build the band lookup table.
+    Any two fingerprints within FP_MAX_DIST bits share at least one band,
+    so a duplicate lookup only compares against a handful of candidates.
+    """
+    if not os.path.exists(FP_INDEX):
+        fp_index = {'files': dict(), 'duplicates': dict()}
+    else:
+        with open(FP_INDEX, 'r') as file_:
+            fp_index = json.load(file_)
+    bands = dict()
+    for file_id, fp_ in fp_index['files'].items():
+        for band in fp_bands(fp_):
+            bands.setdefault(band, set()).add(file_id)
+    return fp_index, bands
+
+
+def find_duplicate(fp_index, bands, fp_):
+    """Return the file_id of an indexed near-duplicate of fp_, or None."""
+    candidates = set()
+    for band in fp_bands(fp_):
+        candidates.update(bands.get(band, set()))
+    best = None
+    for file_id in sorted(candidates):
+        dist = fp_distance(fp_, fp_index['files'][file_id])
+        if dist <= FP_MAX_DIST and (best is None or dist < best[1]):
+            best = (file_id, dist)
+    if best is None:
+        return None
+    return best[0]
+
+
+def add_fingerprint(fp_index, bands, file_id, fp_):
+    """Add the fingerprint of file_id to the index and band lookup table."""
+    fp_index['files'][file_id] = fp_
+    for band in fp_bands(fp_):
+        bands.setdefault(band, set()).add(file_id)
+
+
+def add_duplicate(fp_index, file_path, file_id, orig_id):
+    """Record file_path, slugified to file_id, as a duplicate of orig_id."""
+    file_stat = os.stat(file_path)
+    fp_index['duplicates'][os.path.abspath(file_path)] = {
+        'file_id': file_id, 'duplicate_of': orig_id,
+        'size': file_stat.st_size, 'mtime': file_stat.st_mtime}
+    LOG.info('Duplicate %s of %s', file_id, orig_id)
+
+
+def is_known_duplicate(fp_index, file_path):
+    """Check if file_path is unchanged since it was found a duplicate."""
+    dup = fp_index['duplicates'].get(os.path.abspath(file_path))
+    if dup is None:
+        return False
+    file_stat = os.stat(file_path)
+    return (dup['size'] == file_stat.st_size and
+            dup['mtime'] == file_stat.st_mtime)
+
+
+def write_fp_index(fp_index):
+    """Write back fingerprints.json."""
+    with open(FP_INDEX, 'w') as file_out:
+        json.dump(fp_index, file_out, sort_keys=True, indent=4)
+
+
+def import_file(file_path, fp_index, bands):
+    """
+    Import one speech file into /data, checking for acoustic duplicates.
+    Only file_ids not seen before are fingerprinted, and files already
+    found to be duplicates are skipped if unchanged.
+    """
+    file_id = slugify(os.path.splitext(os.path.basename(file_path))[0])
+    if is_known_duplicate(fp_index, file_path):
+        LOG.info('Duplicate %s of %s', file_id, fp_index['duplicates'][
+            os.path.abspath(file_path)]['duplicate_of'])
+        return
+    elif file_id not in fp_index['files']:
+        try:
+            fp_ = fingerprint(file_path)
+        except Exception:
+            LOG.error('Failed to fingerprint %s', file_path, exc_info=1)
+            fp_ = None
+        if fp_ is not None:
+            orig_id = find_duplicate(fp_index, bands, fp_)
+            if orig_id is not None:
+                add_duplicate(fp_index, file_path, file_id, orig_id)
+                return
+            add_fingerprint(fp_index, bands, file_id, fp_)
+
+    working_dir = get_working_dir(DATA_DIR, file_id)
+    raw_dir = os.path.join(working_dir, 'raw/')
+    resampled_dir = os.path.join(working_dir, 'resampled/')
+    diarize_dir = os.path.join(working_dir, 'diarization/')
+    trans_dir = os.path.join(working_dir, 'transcript/')
+    googleapi_dir = os.path.join(trans_dir, 'googleapi/')
+    textgrid_dir = os.path.join(trans_dir, 'textgrid/')
+    dir_list = [raw_dir, resampled_dir,
+                diarize_dir, trans_dir, googleapi_dir, textgrid_dir]
+    for dir_ in dir_list:
+        if not os.path.exists(dir_):
+            os.makedirs(dir_)
+    shutil.copy2(file_path, raw_dir)
+    LOG.info('Processed %s', file_id)
+
+
 def import_folder(path):
     """
     Import a flat folder into /data.
     Flat folder only contains speech files and no other subfolders.
+    Files acoustically duplicating an imported file_id are not imported,
+    but linked to that file_id in fingerprints.json.
+    """
+    fp_index, bands = load_fp_index()
+    try:
+        for file_ in sorted(os.listdir(path)):
+            if os.path.splitext(file_)[1] in AUDIO_EXTS:
+                import_file(os.path.join(path, file_), fp_index, bands)
+    finally:
+        write_fp_index(fp_index)
+
+
+def fingerprint_data():
+    """
+    Fingerprint raw files of file_ids in /data missing from fingerprints.json.
+    Useful for file_ids imported before duplicate detection, so that
+    duplicates of them, and among them, are found.
     """
-    for file_ in os.listdir(path):
-        if os.path.splitext(file_)[1] in AUDIO_EXTS:
-            file_path = os.path.join(path, file_)
-            file_id = slugify(os.path.splitext(file_)[0])
-            working_dir = os.path.join(DATA_DIR, file_id + '/')
-            raw_dir = os.path.join(working_dir, 'raw/')
-            resampled_dir = os.path.join(working_dir, 'resampled/')
-            diarize_dir = os.path.join(working_dir, 'diarization/')
-            trans_dir = os.path.join(working_dir, 'transcript/')
-            googleapi_dir = os.path.join(trans_dir, 'googleapi/')
-            textgrid_dir = os.path.join(trans_dir, 'textgrid/')
-            dir_list = [raw_dir, resampled_dir,
-                        diarize_dir, trans_dir, googleapi_dir, textgrid_dir]
-            for dir_ in dir_list:
-                if not os.path.exists(dir_):
-                    os.makedirs(dir_)
-            shutil.copy2(file_path, raw_dir)
+    fp_index, bands = load_fp_index()
+    try:
+        for file_id in list_file_ids(DATA_DIR):
+            if file_id in fp_index['files']:
+                continue
+            raw_dir = os.path.join(get_working_dir(DATA_DIR, file_id), 'raw')
+            if not os.path.isdir(raw_dir):
+                continue
+            raw_files = sorted(f for f in os.listdir(raw_dir)
+                               if os.path.isfile(os.path.join(raw_dir, f)))
+            if not raw_files:
+                continue
+            raw_file = os.path.join(raw_dir, raw_files[0])
+            try:
+                fp_ = fingerprint(raw_file)
+            except Exception:
+                LOG.error('Failed to fingerprint %s', raw_file, exc_info=1)
+                continue
+            if fp_ is None:
+                continue
+            # already imported, so kept in the index either way
+            orig_id = find_duplicate(fp_index, bands, fp_)
+            if orig_id is not None:
+                add_duplicate(fp_index, raw_file, file_id, orig_id)
+            add_fingerprint(fp_index, bands, file_id, fp_)
             LOG.info('Processed %s', file_id)
+    finally:
+        write_fp_index(fp_index)
+
+
+def print_duplicates():
+    """
+    Print clusters of acoustic duplicates found in fingerprints.json.
+    Each cluster is a file_id followed by its duplicates.
+    """
+    fp_index, _ = load_fp_index()
+    clusters = dict()
+    for dup_path, dup in fp_index['duplicates'].items():
+        clusters.setdefault(dup['duplicate_of'], []).append(
+            (dup['file_id'], dup_path))
+
+    for file_id in sorted(clusters):
+        print file_id
+        for dup_id, dup_path in sorted(clusters[file_id]):
+            print '    {} ({})'.format(dup_id, dup_path)
+
+    LOG.info('%s duplicates in %s clusters.',
+             len(fp_index['duplicates']), len(clusters))
 
 
 def clear_temp(path):
@@ -72,6 +291,7 @@ def clear_temp(path):
     for root, dirs, _ in os.walk(path):
         if key.issubset(dirs):
             completed_dirs.add(root)
+            del dirs[:]
 
     for dir_ in completed_dirs:
         temp_dir = os.path.join(dir_, 'temp/')
@@ -84,8 +304,8 @@ def migrate(path):
     Convert all folders in a path from old to new structure.
     Path must contain all folders with the old structure.
     """
-    for dir_ in os.listdir(path):
-        working_dir = os.path.join(path, dir_)
+    for dir_ in list_file_ids(path):
+        working_dir = get_working_dir(path, dir_)
         resampled_dir = os.path.join(working_dir, 'resampled/')
         diarize_dir = os.path.join(working_dir, 'diarization/')
         trans_dir = os.path.join(working_dir, 'transcript/')
@@ -113,6 +333,42 @@ def migrate(path):
         LOG.info('Processed %s', dir_)
 
 
+def shard(path):
+    """
+    Convert a flat folder into sharded layout, in place.
+    Folders are moved in parallel into SHARD_ROOT. An interrupted run can
+    be resumed by running again, as folders already moved are no longer
+    listed flat.
+    """
+    shard_root = os.path.join(path, SHARD_ROOT)
+    if not os.path.exists(shard_root):
+        os.makedirs(shard_root)
+    file_ids = list_flat_file_ids(path)
+
+    def move(file_id):
+        """Move one flat folder into its shard."""
+        flat_dir = os.path.normpath(get_flat_dir(path, file_id))
+        shard_dir = os.path.normpath(get_shard_dir(path, file_id))
+        if os.path.exists(shard_dir):
+            LOG.error('Conflict %s, both %s and %s exist',
+                      file_id, flat_dir, shard_dir)
+            return
+        try:
+            os.makedirs(os.path.dirname(shard_dir))
+        except OSError:  # created by another worker
+            if not os.path.isdir(os.path.dirname(shard_dir)):
+                raise
+        os.rename(flat_dir, shard_dir)
+        LOG.info('Processed %s', file_id)
+
+    pool = Pool(SHARD_WORKERS)
+    try:
+        pool.map(move, file_ids)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def stats(path):
     """
     Return some statistics for the folder.
@@ -127,17 +383,29 @@ def stats(path):
             stats = json.load(file_)
 
     # get list of folders that conforms to /data structure
+    # archives count as completed folders
     key = set(['raw', 'resampled', 'diarization', 'transcript'])
     completed_dirs = dict()
-    for root, dirs, _ in os.walk(path):
+    archive_files = dict()
+    for root, dirs, files in os.walk(path):
         if key.issubset(dirs):
             file_id = os.path.basename(os.path.normpath(root))
             completed_dirs[file_id] = root
+            del dirs[:]
+        for file_ in files:
+            if os.path.splitext(file_)[1] == ARCHIVE_EXT:
+                index = read_index(os.path.join(root, file_))
+                if index is not None:
+                    completed_dirs[index['file_id']] = root
+                    archive_files[index['file_id']] = index
 
     # update if id not in stats.json
     for file_id, root in completed_dirs.items():
         resampled_dir = os.path.join(root, 'resampled/')
-        if file_id not in stats.keys():
+        if file_id in archive_files and file_id not in stats.keys():
+            stats[file_id] = archive_files[file_id]['duration']
+            LOG.info('Updated %s', file_id)
+        elif file_id not in stats.keys():
             if len(os.listdir(resampled_dir)) == 1:
                 resampled_file = os.path.join(
                     resampled_dir, os.listdir(resampled_dir)[0])
@@ -171,11 +439,19 @@ def print_completed(path):
     Useful to check /data.
     """
     # get list of folders that conforms to /data structure
+    # archives are completed by definition
     key = set(['raw', 'resampled', 'diarization', 'transcript'])
     completed_dirs = set()
-    for root, dirs, _ in os.walk(path):
+    archive_files = set()
+    for root, dirs, files in os.walk(path):
         if key.issubset(dirs):
             completed_dirs.add(root)
+            del dirs[:]
+        for file_ in files:
+            file_path = os.path.join(root, file_)
+            if (os.path.splitext(file_)[1] == ARCHIVE_EXT and
+                    read_index(file_path) is not None):
+                archive_files.add(file_path)
 
     count = 0
     for dir_ in sorted(completed_dirs):
@@ -183,9 +459,356 @@ def print_completed(path):
         if len(os.listdir(textgrid_dir)) == 1:
             print dir_
             count += 1
+    for archive_file in sorted(archive_files):
+        print archive_file
+        count += 1
 
     LOG.info('%s file_ids completed.', count)
 
+
+def read_seg(seg_file, file_id):
+    """
+    Read a LIUM output into a list of diarized parts, sorted by time.
+    Each part is (key, speaker_gender, start_time, end_time).
+    """
+    parts = list()
+    with open(seg_file, 'r') as file_:
+        for line in file_.readlines():
+            words = line.strip().split()
+            if words and words[0] == file_id:
+                speaker_gender = words[7] + '-' + words[4]
+                start_time = Decimal(words[2]) / 100
+                end_time = (Decimal(words[2]) + Decimal(words[3])) / 100
+                parts.append((int(words[2]), speaker_gender,
+                              str(start_time), str(end_time)))
+    return sorted(parts)
+
+
+def read_index(archive_file):
+    """Return the index of an archive, or None if it is not an archive."""
+    if not zipfile.is_zipfile(archive_file):
+        return None
+    with zipfile.ZipFile(archive_file, 'r') as zip_:
+        if ARCHIVE_INDEX not in zip_.namelist():
+            return None
+        return json.loads(zip_.read(ARCHIVE_INDEX).decode('utf-8'))
+
+
+def block_name(file_id, block):
+    """Return the archive member name of a FLAC block."""
+    return 'resampled/{}/{:05d}.flac'.format(file_id, block)
+
+
+def write_blocks(zip_, resampled_file, file_id):
+    """
+    Store a resampled file into an archive as FLAC blocks, each
+    ARCHIVE_BLOCK seconds long, so any part can be read on its own.
+    Return the wav parameters and the number of blocks.
+    """
+    file_ = wave.open(resampled_file, 'r')
+    params = file_.getparams()
+    temp_dir = tempfile.mkdtemp()
+    wav_file = os.path.join(temp_dir, 'block.wav')
+    flac_file = os.path.join(temp_dir, 'block.flac')
+    block = 0
+    try:
+        frames = file_.readframes(params[2] * ARCHIVE_BLOCK)
+        while frames:
+            file_out = wave.open(wav_file, 'w')
+            file_out.setparams(params)
+            file_out.writeframes(frames)
+            file_out.close()
+            sox.Transformer().build(wav_file, flac_file)
+            zip_.write(flac_file, block_name(file_id, block),
+                       zipfile.ZIP_STORED)
+            block += 1
+            frames = file_.readframes(params[2] * ARCHIVE_BLOCK)
+    finally:
+        file_.close()
+        shutil.rmtree(temp_dir)
+    return params, block
+
+
+def write_flac(zip_, wav_file, name):
+    """
+    Store a wav file into an archive as FLAC.
+    Return False if it cannot be encoded losslessly, e.g. float samples.
+    """
+    temp_dir = tempfile.mkdtemp()
+    flac_file = os.path.join(temp_dir, 'audio.flac')
+    try:
+        file_ = wave.open(wav_file, 'r')
+        file_.close()
+        sox.Transformer().build(wav_file, flac_file)
+        zip_.write(flac_file, name, zipfile.ZIP_STORED)
+    except Exception:
+        LOG.info('Stored %s as wav', wav_file)
+        return False
+    finally:
+        shutil.rmtree(temp_dir)
+    return True
+
+
+def read_flac(zip_, name, out_file):
+    """Decode a FLAC member of an archive into out_file."""
+    temp_dir = tempfile.mkdtemp()
+    flac_file = os.path.join(temp_dir, 'audio.flac')
+    try:
+        with open(flac_file, 'wb') as file_out:
+            file_out.write(zip_.read(name))
+        sox.Transformer().build(flac_file, out_file)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def read_blocks(zip_, index, first, last):
+    """Decode FLAC blocks first to last of an archive, yield their frames."""
+    temp_dir = tempfile.mkdtemp()
+    wav_file = os.path.join(temp_dir, 'block.wav')
+    flac_file = os.path.join(temp_dir, 'block.flac')
+    try:
+        for block in range(first, last + 1):
+            with open(flac_file, 'wb') as file_out:
+                file_out.write(zip_.read(block_name(index['file_id'], block)))
+            sox.Transformer().build(flac_file, wav_file)
+            file_ = wave.open(wav_file, 'r')
+            frames = file_.readframes(file_.getnframes())
+            file_.close()
+            yield frames
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def archive(path):
+    """
+    Pack all completed folders in a path into single archives.
+    The resampled file is stored as FLAC blocks, and diarized parts as
+    offsets into it. All other files are packed as they are.
+    Useful to prepare completed folder for long term storage.
+    """
+    # get list of folders that conforms to /data structure
+    key = set(['raw', 'resampled', 'diarization', 'transcript'])
+    completed_dirs = set()
+    for root, dirs, _ in os.walk(path):
+        if key.issubset(dirs):
+            completed_dirs.add(root)
+            del dirs[:]
+
+    for dir_ in sorted(completed_dirs):
+        textgrid_dir = os.path.join(dir_, 'transcript/textgrid')
+        if len(os.listdir(textgrid_dir)) != 1:
+            LOG.info('Skipped %s, not completed', dir_)
+            continue
+        working_dir = os.path.normpath(dir_)
+        file_id = os.path.basename(working_dir)
+        archive_file = working_dir + ARCHIVE_EXT
+        temp_file = archive_file + '.part'
+        resampled_file = os.path.join(
+            working_dir, 'resampled', file_id + '.wav')
+        diarize_file = os.path.join(
+            working_dir, 'diarization', file_id + '.seg')
+        trans_diarize = os.path.join(
+            working_dir, 'transcript', 'googleapi', file_id + '.txt')
+        if not os.path.exists(resampled_file):
+            LOG.info('Skipped %s, no resampled file', dir_)
+            continue
+
+        # diarized parts as offsets, with their transcripts
+        parts = list()
+        if os.path.exists(diarize_file):
+            parts = read_seg(diarize_file, file_id)
+        lines = list()
+        if os.path.exists(trans_diarize):
+            with open(trans_diarize, 'r') as file_:
+                lines = file_.read().splitlines()
+        if len(lines) != len(parts):
+            lines = [''] * len(parts)
+        index = {'file_id': file_id, 'segments': list()}
+        count = 1
+        for part, line in zip(parts, lines):
+            index['segments'].append({
+                'key': part[0],
+                'name': '{}-{}.wav'.format(count, part[1]),
+                'speaker_gender': part[1],
+                'start_time': part[2],
+                'end_time': part[3],
+                'transcript': line})
+            count += 1
+        # files restored from the index, or regenerated when reprocessing
+        packed = set([os.path.join('resampled', file_id + '.wav'),
+                      os.path.join('temp', file_id + '-compact.wav')])
+        packed.update(os.path.join('diarization', seg['name'])
+                      for seg in index['segments'])
+        index['flac'] = dict()
+
+        try:
+            with zipfile.ZipFile(temp_file, 'w', zipfile.ZIP_DEFLATED,
+                                 allowZip64=True) as zip_:
+                params, blocks = write_blocks(zip_, resampled_file, file_id)
+                index['channels'] = params[0]
+                index['sampwidth'] = params[1]
+                index['rate'] = params[2]
+                index['blocks'] = blocks
+                index['duration'] = str(Decimal(params[3]) / params[2])
+                # everything else, wav as FLAC, mp3 is already compressed
+                for root, _, files in os.walk(working_dir):
+                    for file_ in files:
+                        file_path = os.path.join(root, file_)
+                        name = os.path.relpath(file_path, working_dir)
+                        ext = os.path.splitext(file_)[1]
+                        if name in packed:
+                            continue
+                        elif ext == '.wav' and write_flac(
+                                zip_, file_path, name + '.flac'):
+                            index['flac'][name] = name + '.flac'
+                        elif ext in AUDIO_EXTS:
+                            zip_.write(file_path, name, zipfile.ZIP_STORED)
+                        else:
+                            zip_.write(file_path, name)
+                zip_.writestr(ARCHIVE_INDEX, json.dumps(
+                    index, sort_keys=True, indent=4))
+        except Exception:
+            LOG.error('Failed to archive %s', dir_, exc_info=1)
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            continue
+        os.rename(temp_file, archive_file)
+        shutil.rmtree(working_dir)
+        LOG.info('Processed %s', dir_)
+
+
+def extract(archive_file, name, out_dir):
+    """
+    Extract one member of an archive into out_dir.
+    Diarized parts, e.g. diarization/3-S2-M.wav, are cut on the fly from
+    the FLAC blocks they span, and wav files stored as FLAC are decoded.
+    Return the extracted file, or None if there is no such member.
+    """
+    index = read_index(archive_file)
+    if index is None:
+        LOG.error('%s is not an archive', archive_file)
+        return None
+    segments = dict(('diarization/' + seg['name'], seg)
+                    for seg in index['segments'])
+    out_file = os.path.join(out_dir, os.path.basename(name))
+    with zipfile.ZipFile(archive_file, 'r') as zip_:
+        if name in segments:
+            seg = segments[name]
+            rate = index['rate']
+            block_frames = rate * ARCHIVE_BLOCK
+            frame_size = index['channels'] * index['sampwidth']
+            start = int(Decimal(seg['start_time']) * rate)
+            end = int(Decimal(seg['end_time']) * rate)
+            first = min(start // block_frames, index['blocks'] - 1)
+            last = min(max(end - 1, start) // block_frames,
+                       index['blocks'] - 1)
+            frames = b''.join(read_blocks(zip_, index, first, last))
+            offset = first * block_frames
+            file_out = wave.open(out_file, 'w')
+            file_out.setnchannels(index['channels'])
+            file_out.setsampwidth(index['sampwidth'])
+            file_out.setframerate(rate)
+            file_out.writeframes(frames[(start - offset) * frame_size:
+                                        (end - offset) * frame_size])
+            file_out.close()
+        elif name in index['flac']:
+            read_flac(zip_, index['flac'][name], out_file)
+        elif name in zip_.namelist() and name != ARCHIVE_INDEX:
+            with open(out_file, 'wb') as file_out:
+                file_out.write(zip_.read(name))
+        else:
+            LOG.error('%s not in %s', name, archive_file)
+            return None
+    return out_file
+
+
+def unpack(path):
+    """
+    Unpack all archives in a path back into /data structure.
+    Diarized parts and temporary json dumps are restored for reprocessing.
+    """
+    archive_files = set()
+    for root, _, files in os.walk(path):
+        for file_ in files:
+            if os.path.splitext(file_)[1] == ARCHIVE_EXT:
+                archive_files.add(os.path.join(root, file_))
+
+    for archive_file in sorted(archive_files):
+        index = read_index(archive_file)
+        if index is None:
+            continue
+        working_dir = os.path.join(os.path.dirname(
+            os.path.abspath(archive_file)), index['file_id'] + '/')
+        if os.path.exists(working_dir):
+            LOG.error('Skipped %s, %s exists', archive_file, working_dir)
+            continue
+        try:
+            unpack_archive(archive_file, index, working_dir)
+        except Exception:
+            LOG.error('Failed to unpack %s', archive_file, exc_info=1)
+            shutil.rmtree(working_dir, ignore_errors=True)
+            continue
+        os.remove(archive_file)
+        LOG.info('Processed %s', archive_file)
+
+
+def unpack_archive(archive_file, index, working_dir):
+    """Unpack one archive into working_dir."""
+    file_id = index['file_id']
+    resampled_dir = os.path.join(working_dir, 'resampled/')
+    diarize_dir = os.path.join(working_dir, 'diarization/')
+    trans_dir = os.path.join(working_dir, 'transcript/')
+    googleapi_dir = os.path.join(trans_dir, 'googleapi/')
+    textgrid_dir = os.path.join(trans_dir, 'textgrid/')
+    temp_dir = os.path.join(working_dir, 'temp/')
+    dir_list = [os.path.join(working_dir, 'raw/'), resampled_dir,
+                diarize_dir, trans_dir, googleapi_dir, textgrid_dir,
+                temp_dir]
+    for dir_ in dir_list:
+        if not os.path.exists(dir_):
+            os.makedirs(dir_)
+
+    with zipfile.ZipFile(archive_file, 'r') as zip_:
+        blocks_dir = 'resampled/' + file_id + '/'
+        flac_names = set(index['flac'].values())
+        for name in zip_.namelist():
+            if (name != ARCHIVE_INDEX and name not in flac_names and
+                    not name.startswith(blocks_dir)):
+                zip_.extract(name, working_dir)
+
+        # decode wav files stored as FLAC
+        for name, flac_name in index['flac'].items():
+            out_file = os.path.join(working_dir, name)
+            if not os.path.exists(os.path.dirname(out_file)):
+                os.makedirs(os.path.dirname(out_file))
+            read_flac(zip_, flac_name, out_file)
+
+        # decode resampled file
+        resampled_file = os.path.join(resampled_dir, file_id + '.wav')
+        file_out = wave.open(resampled_file, 'w')
+        file_out.setnchannels(index['channels'])
+        file_out.setsampwidth(index['sampwidth'])
+        file_out.setframerate(index['rate'])
+        for frames in read_blocks(zip_, index, 0, index['blocks'] - 1):
+            file_out.writeframes(frames)
+        file_out.close()
+
+    # cut diarized parts
+    seg_to_dict = dict()
+    dict_to_wav = dict()
+    for seg in index['segments']:
+        diar_part_path = os.path.join(diarize_dir, seg['name'])
+        tfm = sox.Transformer()
+        tfm.trim(Decimal(seg['start_time']), Decimal(seg['end_time']))
+        tfm.build(resampled_file, diar_part_path)
+        value = (seg['speaker_gender'], seg['start_time'], seg['end_time'])
+        seg_to_dict[seg['key']] = value
+        dict_to_wav[seg['key']] = value + (diar_part_path,)
+    with open(os.path.join(temp_dir, 'seg_to_dict.json'), 'w') as file_out:
+        json.dump(seg_to_dict, file_out, sort_keys=True, indent=4)
+    with open(os.path.join(temp_dir, 'dict_to_wav.json'), 'w') as file_out:
+        json.dump(dict_to_wav, file_out, sort_keys=True, indent=4)
+
 if __name__ == '__main__':
     if sys.argv[1] in ['-r', '--crawl']:
         if len(sys.argv) <= 3:
@@ -197,10 +820,29 @@ if __name__ == '__main__':
     elif (sys.argv[1] in ['-c', '--clear']):
         clear_temp(sys.argv[2])
     elif (sys.argv[1] in ['-m', '--migrate']):
-        migrate(sys.argv[2])
+        if '--shard' in sys.argv[3:]:
+            shard(sys.argv[2])
+        else:
+            migrate(sys.argv[2])
     elif (sys.argv[1] in ['-s', '--stats']):
         stats(sys.argv[2])
     elif (sys.argv[1] in ['-p', '--print-completed']):
         print_completed(sys.argv[2])
+    elif (sys.argv[1] in ['-d', '--duplicates']):
+        print_duplicates()
+    elif (sys.argv[1] in ['-f', '--fingerprint']):
+        fingerprint_data()
+    elif (sys.argv[1] in ['-a', '--archive']):
+        archive(sys.argv[2])
+    elif (sys.argv[1] in ['-u', '--unpack']):
+        unpack(sys.argv[2])
+    elif (sys.argv[1] in ['-e', '--extract']):
+        if len(sys.argv) <= 3:
+            LOG.info('Invalid arguments.')
+        else:
+            for name in sys.argv[3:]:
+                out_file = extract(sys.argv[2], name, '.')
+                if out_file is not None:
+                    LOG.info('Extracted %s', out_file)
     else:
         LOG.info('Invalid arguments.')
@@ -0,0 +1,68 @@
+"""Data folder layout."""
+
+import hashlib
+import os
+
+# root of the sharded layout, never a file_id as slugify drops underscores
+SHARD_ROOT = '_shards'
+
+
+def is_sharded(data_dir):
+    """Check for sharded layout, e.g. /data/_shards/ab/cd/[file_id]."""
+    return os.path.isdir(os.path.join(data_dir, SHARD_ROOT))
+
+
+def get_flat_dir(data_dir, file_id):
+    """Return the flat folder of file_id, e.g. /data/[file_id]."""
+    return os.path.join(data_dir, file_id + '/')
+
+
+def get_shard_dir(data_dir, file_id):
+    """Return the sharded folder of file_id, under SHARD_ROOT."""
+    hash_ = hashlib.md5(file_id.encode('utf-8')).hexdigest()
+    return os.path.join(data_dir, SHARD_ROOT, hash_[:2], hash_[2:4],
+                        file_id + '/')
+
+
+def get_working_dir(data_dir, file_id):
+    """
+    Return the folder of file_id in data_dir, in either layout.
+    In sharded layout, file_id folders not yet migrated are still found.
+    """
+    flat_dir = get_flat_dir(data_dir, file_id)
+    if not is_sharded(data_dir):
+        return flat_dir
+    shard_dir = get_shard_dir(data_dir, file_id)
+    if (not os.path.exists(shard_dir) and
+            os.path.isdir(os.path.join(flat_dir, 'raw'))):
+        return flat_dir
+    return shard_dir
+
+
+def list_flat_file_ids(data_dir):
+    """List file_ids directly in data_dir."""
+    return [dir_ for dir_ in os.listdir(data_dir)
+            if dir_ != SHARD_ROOT and
+            os.path.isdir(os.path.join(data_dir, dir_))]
+
+
+def list_file_ids(data_dir):
+    """
+    List file_ids in data_dir, in either layout.
+    A file_id found both flat and sharded is listed once.
+    """
+    file_ids = set(list_flat_file_ids(data_dir))
+    if not is_sharded(data_dir):
+        return sorted(file_ids)
+    shard_root = os.path.join(data_dir, SHARD_ROOT)
+    for shard_1 in os.listdir(shard_root):
+        shard_1_path = os.path.join(shard_root, shard_1)
+        if not os.path.isdir(shard_1_path):
+            continue
+        for shard_2 in os.listdir(shard_1_path):
+            shard_2_path = os.path.join(shard_1_path, shard_2)
+            if os.path.isdir(shard_2_path):
+                file_ids.update(
+                    file_id for file_id in os.listdir(shard_2_path)
+                    if os.path.isdir(os.path.join(shard_2_path, file_id)))
+    return sorted(file_ids)
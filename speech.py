@@ -1,6 +1,7 @@
 """Speech operations."""
 
 import base64
+import io
 import json
 import logging
 import os
@@ -11,16 +12,31 @@ import time
 import wave
 from decimal import Decimal
 
+import numpy
 import sox
 from googleapiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
 
+from layout import get_working_dir, list_file_ids
+
 # initialize paths
 CUR_DIR = os.path.dirname(os.path.realpath(__name__))
 DATA_DIR = os.path.join(CUR_DIR, 'data/')
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
 LIUM_PATH = os.path.join(CUR_DIR, 'lium/LIUM_SpkDiarization-8.4.1.jar')
+COMPACT_STATS_FILE = os.path.join(CUR_DIR, 'compact_stats.json')
+
+# silence compaction: frame length in seconds, percentile of frame rms
+# taken as speech level, silence level relative to speech level, least
+# ratio of speech level to background level to compact at all, longest
+# pause in seconds kept, and audio seconds of the run
+COMPACT_FRAME = 0.01
+COMPACT_SPEECH_PERCENTILE = 95
+COMPACT_SILENCE = 0.05
+COMPACT_MIN_RANGE = 10
+COMPACT_MAX_PAUSE = 0.3
+COMPACT_STATS = {'original': 0.0, 'compacted': 0.0}
 
 # initialize credentials and google apis
 with open(os.path.join(CUR_DIR, 'auth/api.json'), 'r') as api_:
@@ -46,16 +62,82 @@ logging.getLogger('oauth2client').setLevel(logging.ERROR)
 logging.getLogger('googleapiclient').setLevel(logging.ERROR)
 
 
+def compact_silence(wav_file):
+    """
+    Shorten pauses in a 16 bit mono wav file.
+    Leading and trailing silence is cut to half of COMPACT_MAX_PAUSE,
+    internal pauses to COMPACT_MAX_PAUSE. Silence is relative to the
+    file's own speech level, and files without enough dynamic range to
+    tell speech from silence are left as they are.
+    Return the content of the compacted wav file, and a time map:
+    a list of [compacted_time, original_time, duration] of kept spans.
+    """
+    file_ = wave.open(wav_file, 'r')
+    rate = file_.getframerate()
+    samples = numpy.frombuffer(
+        file_.readframes(file_.getnframes()), dtype='<i2')
+    file_.close()
+
+    # rms of each frame, last frame zero-padded
+    frame_len = int(rate * COMPACT_FRAME)
+    n_frames = -(-len(samples) // frame_len)
+    frames = numpy.zeros(n_frames * frame_len)
+    frames[:len(samples)] = samples
+    frames = frames.reshape(n_frames, frame_len)
+    rms = numpy.sqrt(numpy.mean(frames ** 2, axis=1))
+    speech_level = numpy.percentile(rms, COMPACT_SPEECH_PERCENTILE)
+    background_level = numpy.percentile(
+        rms, 100 - COMPACT_SPEECH_PERCENTILE)
+    loud = rms > COMPACT_SILENCE * speech_level
+
+    # keep frames within half a pause of a loud frame
+    if speech_level > COMPACT_MIN_RANGE * background_level:
+        idx = numpy.arange(n_frames)
+        prev_loud = numpy.maximum.accumulate(
+            numpy.where(loud, idx, -n_frames))
+        next_loud = numpy.minimum.accumulate(
+            numpy.where(loud, idx, 2 * n_frames)[::-1])[::-1]
+        pad = int(COMPACT_MAX_PAUSE / 2 / COMPACT_FRAME)
+        keep = numpy.minimum(idx - prev_loud, next_loud - idx) <= pad
+    else:
+        keep = numpy.ones(n_frames, dtype=bool)
+    compacted = samples[numpy.repeat(keep, frame_len)[:len(samples)]]
+
+    # time map of kept spans
+    edges = numpy.diff(numpy.concatenate(([0], keep.astype(int), [0])))
+    starts = numpy.flatnonzero(edges == 1) * frame_len
+    ends = numpy.minimum(
+        numpy.flatnonzero(edges == -1) * frame_len, len(samples))
+    offsets = numpy.concatenate(([0], numpy.cumsum(ends - starts)[:-1]))
+    time_map = [[round(float(off) / rate, 3), round(float(start) / rate, 3),
+                 round(float(end - start) / rate, 3)]
+                for off, start, end in zip(offsets, starts, ends)]
+
+    COMPACT_STATS['original'] += float(len(samples)) / rate
+    COMPACT_STATS['compacted'] += float(len(compacted)) / rate
+
+    buffer_ = io.BytesIO()
+    file_out = wave.open(buffer_, 'wb')
+    file_out.setnchannels(1)
+    file_out.setsampwidth(2)
+    file_out.setframerate(rate)
+    file_out.writeframes(compacted.tobytes())
+    file_out.close()
+    return buffer_.getvalue(), time_map
+
+
 class Speech():
     """
     Speech operations on one file_id.
-    Syntax: Speech(file_id)
+    Syntax: Speech(file_id, compact=False)
+    compact: shorten pauses in audio sent to recognition
     """
 
-    def __init__(self, file_id):
+    def __init__(self, file_id, compact=False):
         # initialize object, get paths programmatically
         self.file_id = file_id
-        self.working_dir = os.path.join(DATA_DIR, self.file_id)
+        self.compact = compact
+        self.working_dir = get_working_dir(DATA_DIR, self.file_id)
         self.raw_dir = os.path.join(self.working_dir, 'raw/')
         raw_file = [f for f in os.listdir(
             self.raw_dir) if os.path.isfile(os.path.join(self.raw_dir, f))][0]
@@ -84,6 +166,10 @@ class Speech():
         self.temp_dict_to_wav = os.path.join(self.temp_dir, 'dict_to_wav.json')
         self.temp_wav_to_trans = os.path.join(
             self.temp_dir, 'wav_to_trans.json')
+        self.temp_compact = os.path.join(self.temp_dir, 'compact.json')
+        self.temp_compact_wav = os.path.join(
+            self.temp_dir, self.file_id + '-compact.wav')
+        self.time_maps = dict()
         self.async_max_retries = 10
         self.async_retry_interval = 30
 
@@ -134,6 +220,32 @@ class Speech():
         file_.close()
         return duration
 
+    def read_audio(self, wav_file):
+        """
+        Return the content of a wav file to be sent for recognition.
+        If compacting, shorten its pauses and keep its time map.
+        """
+        if not self.compact:
+            with open(wav_file, 'rb') as file_:
+                return file_.read()
+        content, time_map = compact_silence(wav_file)
+        self.time_maps[os.path.basename(wav_file)] = time_map
+        return content
+
+    def write_time_maps(self):
+        """Write back time maps of compacted audio to compact.json."""
+        if not self.time_maps:
+            return
+        if os.path.exists(self.temp_compact):
+            with open(self.temp_compact, 'r') as file_:
+                time_maps = json.load(file_)
+        else:
+            time_maps = dict()
+        time_maps.update(self.time_maps)
+        with open(self.temp_compact, 'w') as file_out:
+            json.dump(time_maps, file_out, sort_keys=True, indent=4)
+        self.time_maps = dict()
+
     def convert(self):
         """Resample file_id to 16kHz, 1 channel, 16 bit wav."""
         tfm = sox.Transformer()
@@ -146,8 +258,14 @@ class Speech():
         request_body = {
             'name': self.file_id,
         }
+        media_body = self.resampled_file
+        if self.compact:
+            with open(self.temp_compact_wav, 'wb') as file_out:
+                file_out.write(self.read_audio(self.resampled_file))
+            self.write_time_maps()
+            media_body = self.temp_compact_wav
         OBJECTS.insert(bucket=BUCKET_NAME, body=request_body,
-                       media_body=self.resampled_file).execute()
+                       media_body=media_body).execute()
         LOG.info('upload: %s: File uploaded.', self.file_id)
 
     def diarize(self):
@@ -210,8 +328,8 @@ class Speech():
         for key in sorted_keys:
             value = diarize_dict[str(key)]
             diar_part_path = value[3]
-            with open(diar_part_path, 'rb') as file_:
-                content = base64.b64encode(file_.read()).decode('utf-8')
+            content = base64.b64encode(
+                self.read_audio(diar_part_path)).decode('utf-8')
             request_body = {
                 "audio": {
                     "content": content
@@ -251,6 +369,7 @@ class Speech():
                              result_str.encode('utf-8'))
             diarize_dict[str(key)] = new_value
             LOG.info('recognize_diarize: Done with key %s', key)
+        self.write_time_maps()
         with open(self.temp_wav_to_trans, 'w') as file_out:
             json.dump(diarize_dict, file_out, sort_keys=True, indent=4)
         LOG.info('recognize_diarize: %s: Completed.', self.file_id)
@@ -302,8 +421,9 @@ class Speech():
         Synchronously recognize file_id. Return transcript of resampled file.
         """
         # construct json request
-        with open(self.resampled_file, 'rb') as file_:
-            content = base64.b64encode(file_.read()).decode('utf-8')
+        content = base64.b64encode(
+            self.read_audio(self.resampled_file)).decode('utf-8')
+        self.write_time_maps()
         request_body = {
             "audio": {
                 "content": content
@@ -371,9 +491,9 @@ class Speech():
                 time.sleep(self.async_retry_interval)
 
 
-def sync_pipeline(file_id):
+def sync_pipeline(file_id, compact=False):
     """Synchronous processing pipeline for file_id."""
-    speech_ = Speech(file_id)
+    speech_ = Speech(file_id, compact=compact)
 
     # check for completion
     # if not start the process
@@ -401,9 +521,9 @@ def sync_pipeline(file_id):
     return file_id
 
 
-def async_pipeline(file_id):
+def async_pipeline(file_id, compact=False):
     """Asynchronous processing pipeline for file_id."""
-    speech_ = Speech(file_id)
+    speech_ = Speech(file_id, compact=compact)
 
     # check for completion
     # if not start the process
@@ -433,9 +553,9 @@ def async_pipeline(file_id):
     return file_id
 
 
-def diarize_pipeline(file_id):
+def diarize_pipeline(file_id, compact=False):
     """Synchronous processing pipeline with diarization for file_id."""
-    speech_ = Speech(file_id)
+    speech_ = Speech(file_id, compact=compact)
 
     # check for completion
     # if not start the process
@@ -483,17 +603,41 @@ def diarize_pipeline(file_id):
     return file_id
 
 
-def workflow(method='diarize'):
-    """Workflow for /data."""
-    id_list = sorted([file_id for file_id in os.listdir(DATA_DIR)
-                      if os.path.isdir(os.path.join(DATA_DIR, file_id))])
+def write_compact_stats(method):
+    """Append the audio seconds saved by compaction in this run."""
+    if not os.path.exists(COMPACT_STATS_FILE):
+        runs = list()
+    else:
+        with open(COMPACT_STATS_FILE, 'r') as file_:
+            runs = json.load(file_)
+    saved = COMPACT_STATS['original'] - COMPACT_STATS['compacted']
+    runs.append({
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'method': method,
+        'original': round(COMPACT_STATS['original'], 2),
+        'compacted': round(COMPACT_STATS['compacted'], 2),
+        'saved': round(saved, 2)})
+    with open(COMPACT_STATS_FILE, 'w') as file_out:
+        json.dump(runs, file_out, sort_keys=True, indent=4)
+    LOG.info('Compaction saved %.2f of %.2f audio seconds.',
+             saved, COMPACT_STATS['original'])
+
+
+def workflow(method='diarize', compact=False):
+    """
+    Workflow for /data.
+    compact: shorten pauses in audio sent to recognition
+    """
+    COMPACT_STATS['original'] = 0.0
+    COMPACT_STATS['compacted'] = 0.0
+    id_list = list_file_ids(DATA_DIR)
     if method not in ['diarize', 'sync', 'async']:
         LOG.info('Invalid workflow method. Exiting.')
         return
     elif method == 'diarize':
         for file_id in id_list:
             try:
-                diarize_pipeline(file_id)
+                diarize_pipeline(file_id, compact=compact)
             except:
                 LOG.error('diarize_pipeline: %s: Error occured.',
                           file_id, exc_info=1)
@@ -501,7 +645,7 @@ def workflow(method='diarize'):
     elif method == 'sync':
         for file_id in id_list:
             try:
-                sync_pipeline(file_id)
+                sync_pipeline(file_id, compact=compact)
             except:
                 LOG.error('sync_pipeline: %s: Error occured.',
                           file_id, exc_info=1)
@@ -509,19 +653,23 @@ def workflow(method='diarize'):
     else:
         for file_id in id_list:
             try:
-                async_pipeline(file_id)
+                async_pipeline(file_id, compact=compact)
             except:
                 LOG.error('async_pipeline: %s: Error occured.',
                           file_id, exc_info=1)
                 continue
+    if compact:
+        write_compact_stats(method)
     LOG.info('Workflow completed.')
 
 if __name__ == '__main__':
-    if len(sys.argv) == 1 or sys.argv[1] in ['-d', '--default', '--diarize']:
-        workflow(method='diarize')
-    elif sys.argv[1] in ['-s', '--sync']:
-        workflow(method='sync')
-    elif sys.argv[1] in ['-a', '--async']:
-        workflow(method='async')
+    COMPACT = '--compact' in sys.argv
+    ARGS = [arg for arg in sys.argv[1:] if arg != '--compact']
+    if not ARGS or ARGS[0] in ['-d', '--default', '--diarize']:
+        workflow(method='diarize', compact=COMPACT)
+    elif ARGS[0] in ['-s', '--sync']:
+        workflow(method='sync', compact=COMPACT)
+    elif ARGS[0] in ['-a', '--async']:
+        workflow(method='async', compact=COMPACT)
     else:
         LOG.info('Invalid arguments. Exiting.')